@@ -1,62 +1,373 @@
+import io
 import logging
 import inspect
-import pathlib
-from functools import wraps
-from contextlib import contextmanager, ExitStack
-from typing import Callable, Any, List, Dict, Tuple
+from inspect import CO_GENERATOR
+import os
+from pathlib import PurePath
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from types import FunctionType
+from functools import partial, lru_cache, update_wrapper
+from typing import Callable, Any, Dict, List, Mapping, NamedTuple, Tuple, Optional, Union
 from file_or_name.utils import parameterize, get_first_parameter, ShadowPage
 
 
 __all__ = ["file_or_name"]
 LOGGER = logging.getLogger("file_or_name")
 UTF_8 = "utf-8"
+# Open the files for a call in parallel threads when a function has multiple file arguments that need opening. This
+# can help when opening files is slow (network file systems, cold caches) but for local files the overhead of handing
+# work to a thread is normally larger than the time saved.
+PARALLEL_OPEN = False
+_EXECUTOR = None
+_EXECUTOR_LOCK = threading.Lock()
 
 
-@contextmanager
-def open_files(files: Dict[str, str], function: Callable, *args: List[Any], **kwargs: Dict[str, Any]) -> Dict[str, Any]:
-    """Automatically open files specified by certain arguments and handle cleaning them up.
+def _get_executor() -> ThreadPoolExecutor:
+    """Get the thread pool used to open files in parallel, it is created the first time it is needed."""
+    global _EXECUTOR
+    with _EXECUTOR_LOCK:
+        if _EXECUTOR is None:
+            _EXECUTOR = ThreadPoolExecutor(max_workers=4, thread_name_prefix="file_or_name")
+        return _EXECUTOR
+
+
+@lru_cache(maxsize=32)
+def _resolve_encoding(mode: str) -> Optional[str]:
+    """Get the encoding to open a file with, binary modes don't take an encoding and everything else is utf-8."""
+    return None if "b" in mode else UTF_8
+
+
+def make_opener(mode: str) -> Callable[[Any], Any]:
+    """Create a function that opens a path in a given mode.
+
+    All the inspection of the mode string happens here, once, when a function is decorated.
 
     Args:
-        files: A mapping of argument to file mode. When the decorated function is called all parameters in this
-            mapping will be checked. If the parameter is a string (of a pathlib object) it will be opened in
-            the mode specified by the value in this mapping.
-        function: The user defined function that we are managing the opening of files for.
-        args: A list of positional arguments that that the function is to be called with.
-        kwargs: A dictionary of keyword arguments that the function is to be called with.
+        mode: The mode to open the file in. Modes starting with ``s`` will be shadow paged.
 
-    Yields:
-        A dictionary mapping argument names to values with the string values for arguments in the files mapping
-        replaced by the opened file. The user defined function should be called by ``**`` unpacking this mapping.
+    Returns:
+        A function that takes a path and returns the opened file, it still needs to be entered as a context manager.
+    """
+    encoding = _resolve_encoding(mode)
+    # If they open something with a `s` at the start we will shadow page it. All writes will be done to a temporary
+    # version of the file which will atomically copied over the real file once closed.
+    if mode.startswith("s"):
+        mode = mode[1:]
+        return partial(ShadowPage, mode=mode, encoding=encoding)
+    # A partial of the builtin open is called from C so the mode and encoding are passed without a Python frame.
+    return partial(open, mode=mode, encoding=encoding)
 
-    Raises:
-        ValueError: When shadow paging is requested for a non write-mode file.
+
+class FileParameter(NamedTuple):
+    """Everything we need to know about a parameter whose argument may need to be opened.
+
+    Args:
+        name: The name of the parameter.
+        mode: The mode the file is opened in.
+        index: The index of the parameter in the positional arguments, ``None`` if it can only be passed by keyword.
+        default: The default value of the parameter, ``inspect.Parameter.empty`` when there isn't one.
+        opener: A function that opens a path in ``mode``, see :py:func:`make_opener`.
     """
-    # Get the arguments for this function in a Dict[str, Any] format that maps parameter name to argument value
-    call_args = inspect.getcallargs(function, *args, **kwargs)
-    # Build up a stack of contexts (created by opening file) so we can automatically close them on exit.
-    with ExitStack() as stack:
-        for file_name, mode in files.items():
-            LOGGER.debug("Opening file %s in mode %s", file_name, mode)
-            if file_name not in call_args:
+
+    name: str
+    mode: str
+    index: Optional[int]
+    default: Any
+    opener: Callable[[Any], Any]
+
+
+def make_file_parameters(
+    files: Dict[str, str], parameters: Mapping[str, inspect.Parameter]
+) -> Tuple[FileParameter, ...]:
+    """Collect the information needed to find and open each file argument.
+
+    Args:
+        files: A mapping of argument to file mode.
+        parameters: The parameters of the decorated function, from its ``inspect.Signature``.
+
+    Returns:
+        A :py:class:`FileParameter` for each file argument.
+    """
+    positional = [
+        name
+        for name, param in parameters.items()
+        if param.kind in (inspect.Parameter.POSITIONAL_ONLY, inspect.Parameter.POSITIONAL_OR_KEYWORD)
+    ]
+    return tuple(
+        FileParameter(
+            file_name,
+            mode,
+            positional.index(file_name) if file_name in positional else None,
+            parameters[file_name].default if file_name in parameters else inspect.Parameter.empty,
+            make_opener(mode),
+        )
+        for file_name, mode in files.items()
+    )
+
+
+def find_argument(
+    file_parameter: FileParameter, args: Tuple[Any, ...], kwargs: Dict[str, Any]
+) -> Tuple[Any, Optional[int]]:
+    """Find the value a function is being called with for a file parameter.
+
+    Args:
+        file_parameter: The parameter whose argument we want.
+        args: The positional arguments the function is being called with.
+        kwargs: The keyword arguments the function is being called with.
+
+    Returns:
+        The argument value (``inspect.Parameter.empty`` when it is missing) and its index in ``args``, the index is
+        ``None`` when the value was passed by keyword or comes from the default.
+    """
+    name, _, index, default, _ = file_parameter
+    if name in kwargs:
+        return kwargs[name], None
+    if index is not None and index < len(args):
+        return args[index], index
+    return default, None
+
+
+def replace_argument(
+    name: str, index: Optional[int], value: Any, args: Tuple[Any, ...], kwargs: Dict[str, Any]
+) -> Tuple[Tuple[Any, ...], Dict[str, Any]]:
+    """Replace an argument, found with :py:func:`find_argument`, with a new value.
+
+    Args:
+        name: The name of the parameter.
+        index: The index of the argument in ``args``, ``None`` to pass it by keyword.
+        value: The new value.
+        args: The positional arguments the function is being called with.
+        kwargs: The keyword arguments the function is being called with, these are updated in place.
+
+    Returns:
+        The positional and keyword arguments to call the function with.
+    """
+    if index is None:
+        kwargs[name] = value
+        return args, kwargs
+    return args[:index] + (value,) + args[index + 1 :], kwargs
+
+
+def get_path(value: Any) -> Optional[Union[str, bytes]]:
+    """Get the path a file argument refers to.
+
+    Args:
+        value: The argument value, either something that refers to a file (a string, a pathlib object, or anything
+            else that implements ``os.PathLike``) or an already open file.
+
+    Note:
+        Objects that look like files (``io.IOBase`` subclasses or anything with a ``read`` or ``write`` method) are
+        never treated as paths even if they have an ``__fspath__``, ``MagicMock`` has one for example.
+
+    Returns:
+        The path as a string (or bytes if ``value.__fspath__`` returns bytes), ``None`` if ``value`` is not a path.
+    """
+    if isinstance(value, str):
+        return value
+    if isinstance(value, PurePath):
+        return os.fspath(value)
+    if isinstance(value, io.IOBase) or hasattr(value, "read") or hasattr(value, "write"):
+        return None
+    if isinstance(value, os.PathLike):
+        return os.fspath(value)
+    return None
+
+
+def find_files_to_open(
+    file_parameters: Tuple[FileParameter, ...], args: Tuple[Any, ...], kwargs: Dict[str, Any]
+) -> List[Tuple[FileParameter, Optional[int], Any]]:
+    """Find the file arguments a function is being called with that need to be opened.
+
+    Args:
+        file_parameters: The parameters whose arguments may need to be opened, see :py:func:`make_file_parameters`.
+        args: The positional arguments the function is being called with.
+        kwargs: The keyword arguments the function is being called with.
+
+    Returns:
+        The parameter, index in ``args`` (``None`` when passed by keyword), and path, see :py:func:`get_path`, of
+        each argument that needs to be opened. Missing arguments are included with ``inspect.Parameter.empty`` as
+        the path so the error can be raised by :py:class:`_OpenFiles`. The list is empty when all the file arguments
+        are already open files.
+    """
+    to_open = []
+    for file_parameter in file_parameters:
+        value, index = find_argument(file_parameter, args, kwargs)
+        path = value if value is inspect.Parameter.empty else get_path(value)
+        if path is not None:
+            to_open.append((file_parameter, index, path))
+    return to_open
+
+
+class _OpenFiles:
+    """Automatically open files specified by certain arguments and handle cleaning them up.
+
+    Entering the context returns the positional and keyword arguments with the string values for file arguments
+    replaced by the opened file. The user defined function should be called by unpacking these with ``*`` and
+    ``**``. Files are closed in the reverse order they were opened when the context exits.
+
+    Note:
+        This is a plain class with ``__slots__`` instead of a ``@contextmanager`` wrapping an ``ExitStack``, both of
+        those add allocations to every call of the decorated function.
+
+    Args:
+        to_open: The file arguments to open, see :py:func:`find_files_to_open`. Each one is opened with its
+            parameter's opening function.
+        args: The positional arguments the function is being called with.
+        kwargs: The keyword arguments the function is being called with, this is updated in place.
+    """
+
+    __slots__ = ("to_open", "args", "kwargs", "opened")
+
+    def __init__(
+        self, to_open: List[Tuple[FileParameter, Optional[int], Any]], args: Tuple[Any, ...], kwargs: Dict[str, Any]
+    ):
+        self.to_open = to_open
+        self.args = args
+        self.kwargs = kwargs
+        self.opened = []
+
+    def __enter__(self) -> Tuple[Tuple[Any, ...], Dict[str, Any]]:
+        args = self.args
+        # The kwargs are the wrapper's own ``**kwargs`` dict, it is created fresh for each call so we can update it in
+        # place. Positional arguments are only copied if one of them gets replaced.
+        kwargs = self.kwargs
+        to_open = self.to_open
+        for (file_name, mode, _, _, _), _, path in to_open:
+            if path is inspect.Parameter.empty:
                 raise ValueError(f"Argument {file_name} is missing and expected to be opened in {mode} mode.")
-            if isinstance(call_args[file_name], (str, pathlib.PurePath)):
-                # If they open something with a `s` at the start we will shadow page it. All writes will be done to a
-                # temporary version of the file which will atomically copied over the real file once closed.
-                if mode.startswith("s"):
-                    if "w" not in mode:
-                        raise ValueError(
-                            f"Shadow paging (requested by pre-pending `s` to the {call_args[file_name]}'s file mode) only supported for writing, got {mode[1:]}"
-                        )
-                    call_args[file_name] = stack.enter_context(
-                        ShadowPage(call_args[file_name], mode[1:], encoding=None if "b" in mode else UTF_8)
-                    )
-                # Open the file based on the argument, record the opening in the context of things to be closed, and
-                # add the opened file to the parameter name to argument value mapping
-                else:
-                    call_args[file_name] = stack.enter_context(
-                        open(call_args[file_name], mode=mode, encoding=None if "b" in mode else UTF_8)
-                    )
-        yield call_args
+        try:
+            # Open the files, recording each opening in the list of things to be closed before entering it.
+            if PARALLEL_OPEN and len(to_open) > 1:
+                self._open_parallel(to_open)
+            else:
+                for file_parameter, _, path in to_open:
+                    f = file_parameter.opener(path)
+                    self.opened.append(f)
+                    f.__enter__()
+        except BaseException as e:
+            # __exit__ isn't called when __enter__ fails so close anything we managed to open before the error.
+            self.__exit__(type(e), e, e.__traceback__)
+            raise
+        # Replace the arguments with the opened files
+        for (file_parameter, index, _), f in zip(to_open, self.opened):
+            args, kwargs = replace_argument(file_parameter.name, index, f, args, kwargs)
+        return args, kwargs
+
+    def _open_parallel(self, to_open: List[Tuple[FileParameter, Optional[int], Any]]):
+        """Open files on the shared thread pool so the time spent in the open syscalls overlaps.
+
+        Every file is waited on, even if one fails, so anything that was opened can be closed by ``__exit__``.
+        """
+        futures = [_get_executor().submit(file_parameter.opener, path) for file_parameter, _, path in to_open]
+        error = None
+        for future in futures:
+            try:
+                self.opened.append(future.result())
+            except BaseException as e:
+                if error is None:
+                    error = e
+        if error is not None:
+            raise error
+        for f in self.opened:
+            f.__enter__()
+
+    def __exit__(self, exc, value, tb):
+        # If closing one file fails we still close the rest and raise the first error at the end.
+        error = None
+        for f in reversed(self.opened):
+            try:
+                f.__exit__(exc, value, tb)
+            except BaseException as e:
+                if error is None:
+                    error = e
+        self.opened.clear()
+        if error is not None:
+            raise error
+
+
+def _light_wraps(function: Callable, wrapper: Callable) -> Callable:
+    """Copy the metadata of ``function`` onto ``wrapper``, a lighter weight ``functools.update_wrapper``.
+
+    This copies the same attributes (including ``__annotations__`` and the function ``__dict__``) but skips the
+    generic ``getattr`` loop. Callables that aren't plain functions fall back to ``functools.update_wrapper``.
+
+    Args:
+        function: The user defined function being wrapped.
+        wrapper: The function that wraps it.
+
+    Returns:
+        ``wrapper``, updated to look like ``function``.
+    """
+    if type(function) is not FunctionType:
+        return update_wrapper(wrapper, function)
+    wrapper.__module__ = function.__module__
+    wrapper.__name__ = function.__name__
+    wrapper.__qualname__ = function.__qualname__
+    wrapper.__doc__ = function.__doc__
+    wrapper.__annotations__ = function.__annotations__
+    wrapper.__dict__.update(function.__dict__)
+    # Set after the ``__dict__`` update so a ``__wrapped__`` on ``function`` is not used, like ``update_wrapper``.
+    wrapper.__wrapped__ = function
+    return wrapper
+
+
+def make_single_file_wrapper(
+    function: Callable, signature: inspect.Signature, file_parameter: FileParameter, generator: bool
+) -> Callable:
+    """Create the wrapper for a function with a single file parameter.
+
+    This is the most common case (it is what a bare ``@file_or_name`` creates) so it gets a specialized wrapper
+    that keeps everything about the parameter in local variables and uses a single ``with`` block in place of
+    :py:func:`find_files_to_open` and :py:class:`_OpenFiles`.
+
+    Args:
+        function: The user defined function that we are managing the opening of files for.
+        signature: The signature of ``function``, used to check a call is valid before any file is opened.
+        file_parameter: The parameter whose argument may need to be opened.
+        generator: Is ``function`` a generator function?
+
+    Returns:
+        The wrapper that opens the file argument when needed and calls ``function``, it is not yet decorated
+        with :py:func:`_light_wraps`.
+    """
+    name, mode, _, _, opener = file_parameter
+    missing = f"Argument {name} is missing and expected to be opened in {mode} mode."
+
+    def find_path(args: Tuple[Any, ...], kwargs: Dict[str, Any]) -> Tuple[Optional[Union[str, bytes]], Optional[int]]:
+        """Find the path to open, ``None`` when the argument is already open, and its index in ``args``."""
+        value, index = find_argument(file_parameter, args, kwargs)
+        path = None if value is inspect.Parameter.empty else get_path(value)
+        # Make sure the call is valid before opening the file, opening in write mode truncates it.
+        # This also raises the normal ``TypeError`` when the file argument was not passed.
+        if path is not None or value is inspect.Parameter.empty:
+            signature.bind(*args, **kwargs)
+        # A valid call can only be missing the argument when the decorator names a parameter the function lacks.
+        if value is inspect.Parameter.empty:
+            raise ValueError(missing)
+        return path, index
+
+    if generator:
+
+        def open_arg_file(*args, **kwargs):
+            path, index = find_path(args, kwargs)
+            if path is None:
+                return (yield from function(*args, **kwargs))
+            with opener(path) as f:
+                args, kwargs = replace_argument(name, index, f, args, kwargs)
+                return (yield from function(*args, **kwargs))
+
+    else:
+
+        def open_arg_file(*args, **kwargs):
+            path, index = find_path(args, kwargs)
+            if path is None:
+                return function(*args, **kwargs)
+            with opener(path) as f:
+                args, kwargs = replace_argument(name, index, f, args, kwargs)
+                return function(*args, **kwargs)
+
+    return open_arg_file
 
 
 @parameterize
@@ -83,28 +394,61 @@ def file_or_name(function: Callable, **kwargs: Dict[str, str]) -> Callable:
     Returns:
         A decorated function where specified arguments are interpreted as file names and opened
         automatically.
+
+    Raises:
+        ValueError: When shadow paging is requested for a non write-mode file.
     """
     files = kwargs
+    for file_name, mode in files.items():
+        if mode.startswith("s") and "w" not in mode:
+            raise ValueError(
+                f"Shadow paging (requested by pre-pending `s` to the {file_name}'s file mode) only supported for writing, got {mode[1:]}"
+            )
     # If no file modes are specified in the kwargs we set the first argument to be opened in read mode
     if not files:
         first = get_first_parameter(function)
         LOGGER.debug("No file parameters provided, using %s='r'", first)
         files[first] = "r"
+    # Inspecting the function is slow so we do it once here instead of every time the function is called.
+    signature = inspect.signature(function)
+    file_parameters = make_file_parameters(files, signature.parameters)
+    # The files and modes are fixed once decorated so we log them here rather than on every call.
+    if LOGGER.isEnabledFor(logging.DEBUG):
+        for file_name, mode in files.items():
+            LOGGER.debug(
+                "%s will open file %s in mode %s", getattr(function, "__qualname__", function), file_name, mode
+            )
     # We need to check if we are a generator out here because if we waited to check in the
     # open_arg_files function then open_arg_files would be a generator no matter what because
     # it would have a yield in it (even if that code path wasn't executed for a function)
-    if inspect.isgeneratorfunction(function):
+    if type(function) is FunctionType:
+        generator = bool(function.__code__.co_flags & CO_GENERATOR)
+    else:
+        generator = inspect.isgeneratorfunction(function)
+    if len(file_parameters) == 1:
+        return _light_wraps(function, make_single_file_wrapper(function, signature, file_parameters[0], generator))
+    if generator:
 
-        @wraps(function)
         def open_arg_files(*args, **kwargs):
-            with open_files(files, function, *args, **kwargs) as call_args:
-                yield from function(**call_args)
+            # When the user passed already open files there is nothing for us to do.
+            to_open = find_files_to_open(file_parameters, args, kwargs)
+            if not to_open:
+                return (yield from function(*args, **kwargs))
+            # Make sure the call is valid before opening files, opening in write mode truncates them.
+            signature.bind(*args, **kwargs)
+            with _OpenFiles(to_open, args, kwargs) as (args, kwargs):
+                return (yield from function(*args, **kwargs))
 
     else:
 
-        @wraps(function)
         def open_arg_files(*args, **kwargs):
-            with open_files(files, function, *args, **kwargs) as call_args:
-                return function(**call_args)
+            # When the user passed already open files there is nothing for us to do.
+            to_open = find_files_to_open(file_parameters, args, kwargs)
+            if not to_open:
+                return function(*args, **kwargs)
+            # Make sure the call is valid before opening files, opening in write mode truncates them.
+            signature.bind(*args, **kwargs)
+            with _OpenFiles(to_open, args, kwargs) as (args, kwargs):
+                return function(*args, **kwargs)
 
-    return open_arg_files
+    return _light_wraps(function, open_arg_files)
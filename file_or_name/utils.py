@@ -1,7 +1,8 @@
 import os
 import logging
 import inspect
-from functools import wraps
+from types import FunctionType
+from functools import wraps, partial, lru_cache
 from typing import Callable, Optional
 from tempfile import NamedTemporaryFile
 
@@ -29,24 +30,37 @@ def parameterize(function: Callable) -> Callable:
 
         the first argument of *args is the actual function that will be wrapped
         """
-        if len(args) == 1 and not kwargs and callable(args[0]):
-            return function(args[0])
+        if not kwargs and len(args) == 1:
+            # Check for a plain function before falling back to the more general callable check.
+            wrappee = args[0]
+            if type(wrappee) is FunctionType or callable(wrappee):
+                return function(wrappee)
+        # With only kwargs (the normal ``@file_or_name(wf="w")`` case) a partial applies them from C.
+        if not args:
+            return partial(function, **kwargs)
         return lambda wrappee: function(wrappee, *args, **kwargs)
 
     return decorator
 
 
+@lru_cache(maxsize=128)
 def get_first_parameter(function: Callable) -> str:
     """Get the name of the first parameter of a function.
 
+    Note:
+        Results are cached by function, the same function is often wrapped several times.
+
     Args:
         function: The function whose first parameter name we want.
 
     Returns:
         The name of the first parameter.
     """
-    sig = inspect.signature(function)
-    return list(sig.parameters.keys())[0]
+    # For plain functions we can read the name right off of the code object without building a Signature. Methods
+    # (that have a bound `self`) and functions that wrap others need the signature to get the right answer.
+    if type(function) is FunctionType and not hasattr(function, "__wrapped__") and function.__code__.co_argcount:
+        return function.__code__.co_varnames[0]
+    return next(iter(inspect.signature(function).parameters))
 
 
 class ShadowPage:
@@ -63,14 +77,32 @@ class ShadowPage:
         mode: The mode we should open the shadow file in.
         dir: The directory in which the shadow file should be created.
         encoding: The file type encoding the shadow file should be opened in.
+        fsync: Should the shadow file be flushed to disk with ``os.fsync`` before it replaces the real file? This
+            makes the update durable as well as atomic at the cost of waiting on the disk.
     """
 
-    def __init__(self, path: str, mode: str = "wb", dir: Optional[str] = None, encoding: Optional[str] = None):
+    def __init__(
+        self,
+        path: str,
+        mode: str = "wb",
+        dir: Optional[str] = None,
+        encoding: Optional[str] = None,
+        fsync: bool = False,
+    ):
         self.path = path
+        self.fsync = fsync
+        # Record the ownership and permissions of the file we are replacing now so we don't need another stat when
+        # we swing the pointer. If the file doesn't exist yet there is nothing to copy.
+        try:
+            stat = os.stat(path)
+            self._uid, self._gid, self._mode = stat.st_uid, stat.st_gid, stat.st_mode
+        except FileNotFoundError:
+            self._uid = self._gid = self._mode = None
         # Don't try to delete the temp file when cleaning up, it will either be removed in the
         # swing to the real file or it should be left for debugging
         self.temp_file = NamedTemporaryFile(mode=mode, delete=False, dir=dir, encoding=encoding)
-        LOGGER.debug("Opening shadow file for %s at %s", self.path, self.temp_file.name)
+        if LOGGER.isEnabledFor(logging.DEBUG):
+            LOGGER.debug("Opening shadow file for %s at %s", self.path, self.temp_file.name)
 
     def __enter__(self):
         """Go the normal thing temp files do when entering a context block."""
@@ -84,17 +116,28 @@ class ShadowPage:
     def __exit__(self, exc, value, tb):
         # If we exited this context manager normally swing the pointer to the real path
         if exc is None:
-            # Try to set the permission on the temp file to match the real file
-            try:
-                stat = os.stat(self.path)
-                os.chown(self.temp_file.name, stat.st_uid, stat.st_gid)
-                os.chmod(self.temp_file.name, stat.st_mode)
-            except FileNotFoundError:
-                pass
+            # Use the open file descriptor to flush and set permissions, these skip the path lookup the path based
+            # versions need.
+            fd = self.temp_file.fileno()
+            if self.fsync:
+                self.temp_file.flush()
+                os.fsync(fd)
+            # Set the permission on the temp file to match the real file
+            if self._mode is not None:
+                if hasattr(os, "fchown"):
+                    os.fchown(fd, self._uid, self._gid)
+                if hasattr(os, "fchmod"):
+                    os.fchmod(fd, self._mode)
+                else:
+                    os.chmod(self.temp_file.name, self._mode)
+            # Close the temp file before moving it, you can't replace with an open file on Windows.
+            self.temp_file.__exit__(exc, value, tb)
             os.replace(self.temp_file.name, self.path)
-            LOGGER.debug("Replacing %s with shadow file %s", self.path, self.temp_file.name)
+            if LOGGER.isEnabledFor(logging.DEBUG):
+                LOGGER.debug("Replacing %s with shadow file %s", self.path, self.temp_file.name)
         # If we found an error don't try to replace the old file
         else:
-            LOGGER.debug("Context closed do to %s rolling back update.", exc.__name__)
-        # Normal tempfile cleanup
-        self.temp_file.__exit__(exc, value, tb)
+            if LOGGER.isEnabledFor(logging.DEBUG):
+                LOGGER.debug("Context closed do to %s rolling back update.", exc.__name__)
+            # Normal tempfile cleanup
+            self.temp_file.__exit__(exc, value, tb)
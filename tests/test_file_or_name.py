@@ -1,43 +1,91 @@
+import io
 import os
 import random
 import string
+import shutil
+import inspect
 import pathlib
-from typing import Optional
-from itertools import chain
-from unittest.mock import patch, MagicMock, call
+from typing import Optional, get_type_hints
+from collections import deque
+from contextlib import suppress
+from operator import methodcaller
+from itertools import chain, count, cycle
+from functools import wraps
+from types import SimpleNamespace
+from unittest.mock import patch, MagicMock
 import pytest
-from file_or_name.file_or_name import get_first_parameter, file_or_name, open_files
-
-TEST_DATA = os.path.join(os.path.realpath(os.path.dirname(__file__)), "test_data")
-
-ONE_FILE = os.path.join(TEST_DATA, "one.txt")
+from file_or_name.file_or_name import (
+    get_first_parameter,
+    file_or_name,
+    _OpenFiles,
+    make_file_parameters,
+    find_files_to_open,
+)
+from file_or_name.utils import ShadowPage
+
+TEST_DATA = pathlib.Path(__file__).resolve().parent / "test_data"
+
+ONE_FILE = str(TEST_DATA / "one.txt")
 ONE_VALUES = ["a", "b b", "c c c", "d d d d", "e e e e e"]
 
-TWO_FILE = os.path.join(TEST_DATA, "two.txt")
+TWO_FILE = str(TEST_DATA / "two.txt")
 TWO_VALUES = ["1", "2 2", "3 3 3", "4 4 4 4", "5 5 5 5 5"]
 
+_ALPHABET = string.ascii_lowercase
+_rstrip = methodcaller("rstrip")
+_MODES = ("r", "w", "rb", "wb")
+_TEXT_MODES = frozenset({"r", "w"})
+_FILE_NUMBERS = count()
+_RNG = random.Random()
+# Strings with the default lengths are pre-generated, random_string just hands out the next one.
+_STRING_POOL = cycle(["".join(_RNG.choices(_ALPHABET, k=_RNG.randint(3, 5))) for _ in range(256)])
+# Stand ins for opened files, these are reused (and reset) rather than creating new mocks each time.
+_MOCK_POOL = [MagicMock() for _ in range(20)]
+
+
+class _FakeStrPath(str):
+    """A string path argument that is cheaper to create than ``MagicMock(spec=str)``."""
+
+    __slots__ = ()
+
 
 def random_string(length: Optional[int] = None, min_: int = 3, max_: int = 5) -> str:
-    length = random.randint(min_, max_) if length is None else length
-    return "".join(random.choice(string.ascii_lowercase) for _ in range(length))
+    if length is None and (min_, max_) == (3, 5):
+        return next(_STRING_POOL)
+    length = _RNG.randint(min_, max_) if length is None else length
+    return "".join(_RNG.choices(_ALPHABET, k=length))
+
+
+@pytest.fixture(scope="session")
+def file_contents():
+    """Read the test data once so tests that pass file objects don't need to open the real files."""
+    contents = {}
+    for file_name in (ONE_FILE, TWO_FILE):
+        with open(file_name) as f:
+            contents[file_name] = f.read()
+    return contents
+
+
+@pytest.fixture(scope="session")
+def scratch_dir(tmp_path_factory):
+    """A directory for the files tests write, it is removed once at the end of the session."""
+    path = tmp_path_factory.mktemp("file_or_name", numbered=False)
+    yield path
+    with suppress(FileNotFoundError):
+        shutil.rmtree(path)
 
 
 @pytest.fixture
-def write_file():
-    file_name = os.path.join(TEST_DATA, random_string())
-    yield file_name
-    try:
-        os.remove(file_name)
-    except:
-        pass
+def write_file(scratch_dir):
+    return str(scratch_dir / f"{random_string()}-{next(_FILE_NUMBERS)}")
 
 
 def read(f):
-    return [l.rstrip() for l in f]
+    return list(map(_rstrip, f))
 
 
 def read_gen(f):
-    yield from (l.rstrip() for l in f)
+    yield from map(_rstrip, f)
 
 
 def write(wf, msg):
@@ -49,15 +97,15 @@ def write_gen(wf, msg):
 
 
 def read_two(f, f2):
-    return list(l.rstrip() for l in chain(f, f2))
+    return list(map(_rstrip, chain(f, f2)))
 
 
 def read_two_gen(f, f2):
-    yield from (l.rstrip() for l in chain(f, f2))
+    yield from map(_rstrip, chain(f, f2))
 
 
 def string_plus_file(s, f):
-    return list(chain([s], (l.rstrip() for l in f)))
+    return list(chain([s], map(_rstrip, f)))
 
 
 def test_first_param_positional():
@@ -92,6 +140,37 @@ def test_first_param_keyword_only_with_default():
     assert first_param == "a"
 
 
+def test_first_param_cached():
+    def func(*, a):
+        pass
+
+    with patch("file_or_name.utils.inspect.signature", wraps=inspect.signature) as sig_patch:
+        assert get_first_parameter(func) == "a"
+        assert get_first_parameter(func) == "a"
+    sig_patch.assert_called_once()
+
+
+def test_first_param_method():
+    class Reader:
+        def func(self, a, b):
+            pass
+
+    first_param = get_first_parameter(Reader().func)
+    assert first_param == "a"
+
+
+def test_first_param_wrapped():
+    def func(a, b):
+        pass
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        pass
+
+    first_param = get_first_parameter(wrapper)
+    assert first_param == "a"
+
+
 def test_file_or_name_default_to_first():
     r = file_or_name(read)
     data = r(ONE_FILE)
@@ -110,6 +189,18 @@ def test_file_or_name_gen_default_to_first():
     assert data == TWO_VALUES
 
 
+def test_file_or_name_file_object(file_contents):
+    r = file_or_name(read)
+    data = r(io.StringIO(file_contents[ONE_FILE]))
+    assert data == ONE_VALUES
+
+
+def test_file_or_name_gen_file_object(file_contents):
+    r = file_or_name(read_gen)
+    data = list(r(io.StringIO(file_contents[TWO_FILE])))
+    assert data == TWO_VALUES
+
+
 def test_file_or_name_write_mode(write_file):
     w = file_or_name(wf="w")(write)
     data = "\n".join(random_string() for _ in range(random.randint(1, 10)))
@@ -122,7 +213,7 @@ def test_file_or_name_write_mode(write_file):
 def test_file_or_name_gen_write_mode(write_file):
     w = file_or_name(wf="w")(write_gen)
     data = "\n".join(random_string() for _ in range(random.randint(1, 10)))
-    list(w(write_file, data))
+    deque(w(write_file, data), maxlen=0)
     with open(write_file) as f:
         res = f.read()
     assert res == data
@@ -142,7 +233,7 @@ def test_file_or_name_gen_write_mode_pathlib(write_file):
     w = file_or_name(wf="w")(write_gen)
     data = "\n".join(random_string() for _ in range(random.randint(1, 10)))
     write_file = pathlib.Path(write_file)
-    list(w(write_file, data))
+    deque(w(write_file, data), maxlen=0)
     with open(write_file) as f:
         res = f.read()
     assert res == data
@@ -184,46 +275,68 @@ def test_file_or_name_skips_first_if_other_specified_pathlib():
     assert data == [pathlib.Path(string)] + ONE_VALUES
 
 
-def test_open_files_error_on_missing_argument():
-    with patch("file_or_name.file_or_name_module.inspect.getcallargs") as call_patch:
-        files = {"missing": "r"}
-        call_patch.return_value = {}
-        with pytest.raises(ValueError):
-            with open_files(files, lambda x: x) as f:
-                pass
-
-
-def test_open_files_opens_and_closes_files():
-    gold = [
-        {"parameter": random_string(), "mode": random.choice(["r", "w", "rb", "wb"])}
-        for _ in range(random.randint(1, 10))
+def test_make_file_parameters():
+    def func(a, b, c="c", *args, d, e=None):
+        pass
+
+    params = make_file_parameters({"c": "r", "e": "w", "a": "rb"}, inspect.signature(func).parameters)
+    assert [(p.name, p.mode, p.index, p.default) for p in params] == [
+        ("c", "r", 2, "c"),
+        ("e", "w", None, None),
+        ("a", "rb", 0, inspect.Parameter.empty),
     ]
-    for g in gold:
-        g["encoding"] = "utf-8" if g["mode"] in {"r", "w"} else None
+
+
+def test_file_or_name_var_positional():
+    @file_or_name
+    def read_and_rest(f, *rest):
+        return read(f), rest
+
+    assert read_and_rest(ONE_FILE, 1, 2) == (ONE_VALUES, (1, 2))
+
+
+def test_open_files_error_on_missing_argument():
+    files = {"missing": "r"}
+    with pytest.raises(ValueError):
+        with _OpenFiles(find_files_to_open(make_file_parameters(files, {}), (), {}), (), {}) as f:
+            pass
+
+
+@patch("file_or_name.file_or_name_module.open")
+def test_open_files_opens_and_closes_files(open_patch):
+    gold = []
+    files = {}
+    args = {}
+    mocks = {}
+    pool = iter(_MOCK_POOL)
+    for _ in range(random.randint(1, 10)):
+        g = {"parameter": random_string(), "mode": random.choice(_MODES)}
+        g["encoding"] = "utf-8" if g["mode"] in _TEXT_MODES else None
         if random.random() > 0.5:
-            g["value"] = MagicMock()
+            g["value"] = SimpleNamespace(close=MagicMock())
             g["string"] = False
         else:
-            g["value"] = MagicMock(spec=str)
+            g["value"] = _FakeStrPath(random_string())
             g["string"] = True
-    files = {g["parameter"]: g["mode"] for g in gold}
-    args = {g["parameter"]: g["value"] for g in gold}
-    mocks = {g["value"]: MagicMock() if g["string"] else g["value"] for g in gold}
-    with patch("file_or_name.file_or_name_module.inspect.getcallargs") as call_patch, patch(
-        "file_or_name.file_or_name_module.open"
-    ) as open_patch:
-        call_patch.return_value = args
-        open_patch.side_effect = lambda *args, **kwargs: mocks[args[0]]
-        with open_files(files, lambda x: x):
-            for g in gold:
-                args = call(g["value"], mode=g["mode"], encoding=g["encoding"])
-                if g["string"]:
-                    assert args in open_patch.call_args_list
-                else:
-                    assert args not in open_patch.call_args_list
+            opened = next(pool)
+            opened.reset_mock()
+            mocks[g["value"]] = opened
+        files[g["parameter"]] = g["mode"]
+        args[g["parameter"]] = g["value"]
+        gold.append(g)
+    open_patch.side_effect = lambda *args, **kwargs: mocks[args[0]]
+    with _OpenFiles(find_files_to_open(make_file_parameters(files, {}), (), args), (), args) as (_, opened_kwargs):
+        seen = {(call_args, frozenset(call_kwargs.items())) for call_args, call_kwargs in open_patch.call_args_list}
         for g in gold:
-            if not g["string"]:
-                mocks[g["value"]].close.assert_not_called()
+            args = ((g["value"],), frozenset({"mode": g["mode"], "encoding": g["encoding"]}.items()))
+            if g["string"]:
+                assert args in seen
+            else:
+                # Already open files aren't hashable, check they were passed through untouched instead.
+                assert opened_kwargs[g["parameter"]] is g["value"]
+    for g in gold:
+        if not g["string"]:
+            g["value"].close.assert_not_called()
 
 
 @file_or_name(wf="sw")
@@ -234,14 +347,11 @@ def writing_test(wf, data, die=False):
 
 
 @pytest.fixture
-def data():
-    file_name = random_string()
+def data(write_file):
     gold_data = random_string()
     og_data = random_string()
-    with open(file_name, "w") as wf:
-        wf.write(og_data)
-    yield file_name, gold_data, og_data
-    os.remove(file_name)
+    pathlib.Path(write_file).write_bytes(og_data.encode("utf-8"))
+    return write_file, gold_data, og_data
 
 
 def test_shadow_page_atomic(data):
@@ -250,23 +360,220 @@ def test_shadow_page_atomic(data):
         writing_test(file_name, gold_data, die=True)
     except ValueError:
         pass
-    with open(file_name) as f:
-        res = f.read()
-    assert res == og_data
+    assert pathlib.Path(file_name).read_text() == og_data
 
 
 def test_shadow_page_write(data):
     file_name, gold_data, og_data = data
     writing_test(file_name, gold_data, die=False)
-    with open(file_name) as f:
-        res = f.read()
-    assert res == gold_data
+    assert pathlib.Path(file_name).read_text() == gold_data
 
 
 def test_shadow_page_on_reads(data):
-    @file_or_name(f="sr")
-    def test(f):
-        pass
+    with pytest.raises(ValueError):
+
+        @file_or_name(f="sr")
+        def test(f):
+            pass
+
+
+def test_file_or_name_default_argument():
+    @file_or_name
+    def read_default(f=ONE_FILE):
+        return read(f)
+
+    assert read_default() == ONE_VALUES
+    assert read_default(TWO_FILE) == TWO_VALUES
+
+
+@patch("file_or_name.file_or_name_module.open")
+def test_open_files_closes_opened_on_error(open_patch):
+    opened = MagicMock()
+    open_patch.side_effect = [opened, OSError]
+    kwargs = {"a": "a", "b": "b"}
+    with pytest.raises(OSError):
+        with _OpenFiles(find_files_to_open(make_file_parameters({"a": "r", "b": "r"}, {}), (), kwargs), (), kwargs):
+            pass
+    opened.__exit__.assert_called_once()
+
+
+def test_file_or_name_skips_opening_files(file_contents):
+    r = file_or_name(f="r", f2="r")(read_two)
+    f, f2 = io.StringIO(file_contents[ONE_FILE]), io.StringIO(file_contents[TWO_FILE])
+    with patch("file_or_name.file_or_name_module._OpenFiles") as open_patch:
+        data = r(f, f2=f2)
+    open_patch.assert_not_called()
+    assert data == ONE_VALUES + TWO_VALUES
+
+
+def test_file_or_name_gen_skips_opening_files(file_contents):
+    r = file_or_name(f="r", f2="r")(read_two_gen)
+    f, f2 = io.StringIO(file_contents[ONE_FILE]), io.StringIO(file_contents[TWO_FILE])
+    with patch("file_or_name.file_or_name_module._OpenFiles") as open_patch:
+        data = list(r(f, f2))
+    open_patch.assert_not_called()
+    assert data == ONE_VALUES + TWO_VALUES
+
+
+def test_file_or_name_gen_return_value(file_contents):
+    @file_or_name(f="r", f2="r")
+    def returning(f, f2):
+        yield from chain(f, f2)
+        return "returned"
+
+    def drain(gen):
+        with pytest.raises(StopIteration) as e:
+            while True:
+                next(gen)
+        return e.value.value
+
+    f, f2 = io.StringIO(file_contents[ONE_FILE]), io.StringIO(file_contents[TWO_FILE])
+    assert drain(returning(ONE_FILE, TWO_FILE)) == drain(returning(f, f2)) == "returned"
+
+
+def test_file_or_name_keyword_argument():
+    r = file_or_name(read)
+    assert r(f=ONE_FILE) == ONE_VALUES
+
+
+def test_file_or_name_gen_keyword_argument():
+    r = file_or_name(read_gen)
+    assert list(r(f=pathlib.Path(ONE_FILE))) == ONE_VALUES
 
+
+def test_file_or_name_mock_file_passed_through():
+    @file_or_name
+    def single(f):
+        return f
+
+    @file_or_name(f="r", wf="w")
+    def multiple(f, wf):
+        return f, wf
+
+    f = MagicMock()
+    wf = MagicMock()
+    with patch("file_or_name.file_or_name_module.open") as open_patch:
+        assert single(f) is f
+        assert multiple(f, wf) == (f, wf)
+        open_patch.assert_not_called()
+    f.close.assert_not_called()
+    wf.close.assert_not_called()
+
+
+def test_file_or_name_error_on_missing_argument(data):
+    file_name, _, og_data = data
+    r = file_or_name(read)
+    with pytest.raises(TypeError):
+        r()
+    w = file_or_name(wf="w")(write)
+    with pytest.raises(TypeError):
+        w(file_name)
+    assert pathlib.Path(file_name).read_text() == og_data
+    m = file_or_name(f="r", wf="w")(lambda f, wf: None)
+    with pytest.raises(TypeError):
+        m(f=ONE_FILE)
+
+
+def test_file_or_name_error_on_unknown_parameter():
+    r = file_or_name(missing="r")(read)
+    with pytest.raises(ValueError):
+        r(ONE_FILE)
+    m = file_or_name(f="r", missing="r")(read)
     with pytest.raises(ValueError):
-        test("aaa")
+        m(ONE_FILE)
+
+
+def test_file_or_name_path_like():
+    class PathLike:
+        def __init__(self, path):
+            self.path = path
+
+        def __fspath__(self):
+            return self.path
+
+    r = file_or_name(f="r", f2="r")(read_two)
+    data = r(PathLike(ONE_FILE), PathLike(TWO_FILE))
+    assert data == ONE_VALUES + TWO_VALUES
+
+
+def test_file_or_name_metadata():
+    def documented(f: str, f2: Optional[str] = None) -> int:
+        """Some documentation."""
+
+    documented.extra = 1
+
+    for wrapped in (file_or_name(documented), file_or_name(f="r", f2="r")(documented)):
+        assert wrapped.__name__ == documented.__name__
+        assert wrapped.__qualname__ == documented.__qualname__
+        assert wrapped.__doc__ == documented.__doc__
+        assert wrapped.__wrapped__ is documented
+        assert inspect.signature(wrapped) == inspect.signature(documented)
+        assert get_type_hints(wrapped) == get_type_hints(documented)
+        assert wrapped.extra == 1
+
+
+def test_shadow_page_keeps_permissions(data):
+    file_name, gold_data, og_data = data
+    os.chmod(file_name, 0o640)
+    writing_test(file_name, gold_data, die=False)
+    assert os.stat(file_name).st_mode & 0o777 == 0o640
+
+
+def test_shadow_page_fsync(data):
+    file_name, gold_data, og_data = data
+    with patch("file_or_name.utils.os.fsync") as fsync_patch:
+        with ShadowPage(file_name, "w", fsync=True) as wf:
+            wf.write(gold_data)
+    fsync_patch.assert_called_once()
+    assert pathlib.Path(file_name).read_text() == gold_data
+
+
+def test_file_or_name_parallel_open():
+    r = file_or_name(f="r", f2="r")(read_two)
+    with patch("file_or_name.file_or_name_module.PARALLEL_OPEN", True):
+        data = r(ONE_FILE, f2=pathlib.Path(TWO_FILE))
+    assert data == ONE_VALUES + TWO_VALUES
+
+
+@patch("file_or_name.file_or_name_module.open")
+@patch("file_or_name.file_or_name_module.PARALLEL_OPEN", True)
+def test_open_files_parallel_closes_opened_on_error(open_patch):
+    opened = MagicMock()
+
+    def fake_open(path, *args, **kwargs):
+        if path == "b":
+            raise OSError
+        return opened
+
+    open_patch.side_effect = fake_open
+    kwargs = {"a": "a", "b": "b"}
+    with pytest.raises(OSError):
+        with _OpenFiles(find_files_to_open(make_file_parameters({"a": "r", "b": "r"}, {}), (), kwargs), (), kwargs):
+            pass
+    opened.__exit__.assert_called_once()
+
+
+def test_shadow_page_entered_once(data):
+    file_name, gold_data, og_data = data
+    with patch.object(ShadowPage, "__enter__", autospec=True, side_effect=lambda self: self) as enter_patch:
+        writing_test(file_name, gold_data)
+    enter_patch.assert_called_once()
+    assert pathlib.Path(file_name).read_text() == gold_data
+
+
+def test_file_or_name_bad_call_leaves_file(data):
+    file_name, gold_data, og_data = data
+    w = file_or_name(wf="w")(write)
+    with pytest.raises(TypeError):
+        w(file_name, gold_data, "extra")
+    with pytest.raises(TypeError):
+        w(file_name, gold_data, wf=file_name)
+    assert pathlib.Path(file_name).read_text() == og_data
+
+
+def test_file_or_name_multiple_files_bad_call_leaves_file(data):
+    file_name, gold_data, og_data = data
+    w = file_or_name(f="r", wf="w")(lambda f, wf: None)
+    with pytest.raises(TypeError):
+        w(ONE_FILE, file_name, "extra")
+    assert pathlib.Path(file_name).read_text() == og_data